@@ -4,14 +4,19 @@ MLGWSC-1 mock data challenge. Written by Ondřej Zelenka.
 """
 # Import modules
 from argparse import ArgumentParser
+from collections import namedtuple
+import inspect
 import logging
 import h5py
 from tqdm import tqdm
 import os.path
 import numpy as np
+import scipy.fft
 from pycbc.psd import inverse_spectrum_truncation, interpolate
 import pycbc.types
 import multiprocessing as mp
+import queue
+import threading
 
 
 def copy_attrs(in_obj, out_obj):
@@ -20,6 +25,46 @@ def copy_attrs(in_obj, out_obj):
     return
 
 
+MAX_CHUNK_LEN = 1 << 20
+
+
+def chunk_shape(shape):
+    """Chunk shape used for storing a whitened segment of the given
+    shape. Segments are stored in chunks of at most `MAX_CHUNK_LEN`
+    samples. Empty segments are not chunked explicitly.
+    """
+    if shape[0] == 0:
+        return None
+    return (min(shape[0], MAX_CHUNK_LEN),)
+
+
+# A segment that was already passed through the HDF5 filter pipeline.
+# `chunks` is a list of (offset, filter_mask, raw bytes) tuples.
+EncodedSegment = namedtuple('EncodedSegment', ['shape', 'dtype', 'chunks'])
+
+
+def encode_segment(data, ds_write_kwargs):
+    """Compress a segment chunk by chunk with the HDF5 filters given by
+    `ds_write_kwargs`, such that it can be stored with
+    `write_direct_chunk`. The filters are applied by writing the data
+    to an in-memory HDF5 file, so any filter known to HDF5 can be used.
+    """
+    # Register the filters of hdf5plugin in this process. Workers that
+    # are not forked from the main process do not have them otherwise.
+    import hdf5plugin  # noqa: F401
+    with h5py.File('encode', 'w', driver='core',
+                   backing_store=False) as fp:
+        ds = fp.create_dataset('data', data=data,
+                               chunks=chunk_shape(data.shape),
+                               **ds_write_kwargs)
+        chunks = []
+        for i in range(ds.id.get_num_chunks()):
+            offset = ds.id.get_chunk_info(i).chunk_offset
+            filter_mask, raw = ds.id.read_direct_chunk(offset)
+            chunks.append((offset, filter_mask, raw))
+    return EncodedSegment(data.shape, data.dtype, chunks)
+
+
 class SafeCaster:
     def __init__(self, dtype_bits):
         if dtype_bits is None:
@@ -40,10 +85,66 @@ class SafeCaster:
             return in_arr.astype(self.dtype)
 
 
+def inverse_sqrt_psd(psd, delta_f, max_filter_len, trunc_method='hann',
+                     low_frequency_cutoff=None):
+    """Compute the frequency-domain whitening filter 1 / sqrt(PSD).
+
+    Arguments
+    ---------
+    psd : pycbc.types.FrequencySeries
+        The PSD from which the filter is computed.
+    delta_f : float
+        Frequency resolution of the strain the filter is applied to.
+    max_filter_len : int
+        Maximum length of the time-domain filter in samples.
+    trunc_method : {None, 'hann'}
+        Function used for truncating the time-domain filter.
+        None produces a hard truncation at `max_filter_len`.
+    low_frequency_cutoff : {None, float}
+        Low frequency cutoff to be passed to the inverse spectrum
+        truncation.
+
+    Returns
+    -------
+    inv_sqrt_psd : numpy array
+        The inverse square root of the interpolated and truncated PSD.
+        Frequency bins where the PSD vanishes are set to zero.
+
+    """
+    psd = interpolate(psd, delta_f)
+    psd = inverse_spectrum_truncation(psd,
+                                      max_filter_len=max_filter_len,
+                                      low_frequency_cutoff=low_frequency_cutoff,  # noqa: E501
+                                      trunc_method=trunc_method)
+    psd_arr = psd.numpy()
+    inv_sqrt_psd = np.empty_like(psd_arr)
+    np.sqrt(psd_arr, out=inv_sqrt_psd)
+    np.reciprocal(inv_sqrt_psd, out=inv_sqrt_psd, where=inv_sqrt_psd != 0.)
+    return inv_sqrt_psd
+
+
+def as_frequency_series(psd, delta_t):
+    """Interpret a PSD given as numpy array or FrequencySeries as
+    `pycbc.types.FrequencySeries`.
+    """
+    if isinstance(psd, np.ndarray):
+        assert psd.ndim == 1
+        logging.warning("WARNING: Assuming PSD delta_f based "
+                        "on delta_t, length of PSD and EVEN length "
+                        "of original time series. Tread carefully!")
+        assumed_duration = delta_t*(2*len(psd)-2)
+        return pycbc.types.FrequencySeries(psd,
+                                           delta_f=1./assumed_duration)
+    elif isinstance(psd, pycbc.types.FrequencySeries):
+        return psd
+    else:
+        raise ValueError("Unknown format of PSD.")
+
+
 def whiten(strain, delta_t=1./2048., segment_duration=0.5,
            max_filter_duration=0.25, trunc_method='hann',
            remove_corrupted=True, low_frequency_cutoff=None, psd=None,
-           **kwargs):
+           inv_sqrt_psd=None, fft_workers=-1, shared_psd=False, **kwargs):
     """Whiten a strain.
 
     Arguments
@@ -72,6 +173,19 @@ def whiten(strain, delta_t=1./2048., segment_duration=0.5,
     psd : {None, numpy array}
         PSD to be used for whitening. If not supplied,
         it is estimated from the time series.
+    inv_sqrt_psd : {None, numpy array}
+        Precomputed whitening filter as returned by `inverse_sqrt_psd`
+        for the frequency resolution of the strain. If supplied, `psd`
+        is ignored. For two-dimensional strains it may either be shared
+        by all rows or contain one filter per row.
+    fft_workers : {int, -1}
+        Number of threads used by `scipy.fft` for the whitening
+        transforms. Negative values count from the number of CPUs.
+    shared_psd : {False, boolean}
+        If True and no PSD is supplied for a two-dimensional strain, a
+        single PSD is estimated from the concatenation of all rows and
+        used to whiten every row. Only use this if the noise is
+        stationary across rows.
     kwargs : keywords
         Additional keyword arguments are passed on to the
         `pycbc.psd.welch` method.
@@ -82,78 +196,164 @@ def whiten(strain, delta_t=1./2048., segment_duration=0.5,
         The whitened time series.
 
     """
-    if strain.ndim == 1:
-        colored_ts = pycbc.types.TimeSeries(strain, delta_t=delta_t)
-        if psd is None:
-            psd = colored_ts.psd(segment_duration, **kwargs)
-        elif isinstance(psd, np.ndarray):
-            assert psd.ndim == 1
-            logging.warning("WARNING: Assuming PSD delta_f based "
-                            "on delta_t, length of PSD and EVEN length "
-                            "of original time series. Tread carefully!")
-            assumed_duration = delta_t*(2*len(psd)-2)
-            psd = pycbc.types.FrequencySeries(psd,
-                                              delta_f=1./assumed_duration)
-        elif isinstance(psd, pycbc.types.FrequencySeries):
-            pass
+    if strain.ndim not in (1, 2):
+        raise ValueError("Strain numpy array dimension must be 1 or 2.")
+
+    nsamples = strain.shape[-1]
+    max_filter_len = int(max_filter_duration*(1./delta_t))
+    if inv_sqrt_psd is None:
+        strains_1d = [strain] if strain.ndim == 1 else strain
+        if strain.ndim == 1:
+            psds_1d = [psd]
+        elif psd is None and shared_psd:
+            colored_ts = pycbc.types.TimeSeries(strain.reshape(-1),
+                                                delta_t=delta_t)
+            psds_1d = [colored_ts.psd(segment_duration, **kwargs)]
+        elif psd is None:
+            psds_1d = [None for _ in strain]
+        elif isinstance(psd, (np.ndarray, pycbc.types.FrequencySeries))\
+                and psd.ndim == 1:
+            psds_1d = [psd]
         else:
-            raise ValueError("Unknown format of PSD.")
-        psd = interpolate(psd, colored_ts.delta_f)
-        max_filter_len = int(max_filter_duration*colored_ts.sample_rate)
-
-        psd = inverse_spectrum_truncation(psd,
-                                          max_filter_len=max_filter_len,
-                                          low_frequency_cutoff=low_frequency_cutoff,  # noqa: E501
-                                          trunc_method=trunc_method)
-
-        # inv_psd = np.array([0. if num==0. else 1./num for num in psd])
-        inv_psd = 1./psd
-        white_ts = (colored_ts.to_frequencyseries()
-                    * inv_psd**0.5).to_timeseries()
-
-        if remove_corrupted:
-            kmin = max_filter_len//2
-            kmax = (len(colored_ts)-max_filter_len//2)
-            white_ts = white_ts[kmin:kmax]
-
-        return white_ts.numpy()
-
-    elif strain.ndim == 2:
-        psds_1d = None
-        if isinstance(psd, np.ndarray):
-            if psd.ndim == 1:
-                psds_1d = [psd for _ in strain]
-        if psds_1d is None:
-            if (psd is None) or isinstance(psd, pycbc.types.FrequencySeries):
-                psds_1d = [psd for _ in strain]
+            assert len(psd) == len(strain)
+            psds_1d = psd
+
+        filters = []
+        for i, psd_1d in enumerate(psds_1d):
+            if psd_1d is None:
+                colored_ts = pycbc.types.TimeSeries(strains_1d[i],
+                                                    delta_t=delta_t)
+                psd_1d = colored_ts.psd(segment_duration, **kwargs)
             else:
-                assert len(psd) == len(strain)
-                psds_1d = psd
-
-        white_segments = [whiten(sd_strain, delta_t=delta_t,
-                                 segment_duration=segment_duration,
-                                 max_filter_duration=max_filter_duration,
-                                 trunc_method=trunc_method,
-                                 remove_corrupted=remove_corrupted,
-                                 low_frequency_cutoff=low_frequency_cutoff,
-                                 psd=psd_1d,
-                                 **kwargs)
-                          for sd_strain, psd_1d in zip(strain, psds_1d)]
-        return np.stack(white_segments, axis=0)
+                psd_1d = as_frequency_series(psd_1d, delta_t)
+            filters.append(inverse_sqrt_psd(psd_1d, 1./(nsamples*delta_t),
+                                            max_filter_len,
+                                            trunc_method=trunc_method,
+                                            low_frequency_cutoff=low_frequency_cutoff))  # noqa: E501
+        if strain.ndim == 1:
+            inv_sqrt_psd = filters[0]
+        else:
+            inv_sqrt_psd = np.stack(filters, axis=0)
+
+    # Rows of two-dimensional strains share delta_t, so the transforms
+    # are done in a single batched FFT along the last axis.
+    fs = scipy.fft.rfft(strain, axis=-1, workers=fft_workers)
+    fs *= inv_sqrt_psd
+    white = scipy.fft.irfft(fs, n=nsamples, axis=-1, workers=fft_workers)
+
+    if remove_corrupted:
+        kmin = max_filter_len//2
+        kmax = (nsamples-max_filter_len//2)
+        white = white[..., kmin:kmax]
+
+    return white
+
+
+_INV_SQRT_PSD_CACHE = {}
+_READ_BUFFERS = {}
+
+
+def read_segment(ds):
+    """Read an HDF5 dataset into a preallocated buffer that is reused
+    across calls. The returned array is only valid until the next call
+    for a dataset of the same data type and must not be modified.
+    """
+    size = int(np.prod(ds.shape))
+    buf = _READ_BUFFERS.get(ds.dtype)
+    if buf is None or len(buf) < size:
+        buf = np.empty(size, dtype=ds.dtype)
+        _READ_BUFFERS[ds.dtype] = buf
+    out = buf[:size].reshape(ds.shape)
+    ds.read_direct(out)
+    return out
+
+
+def unpack_psd(kwargs):
+    """Replace the entries `psd` (numpy array) and `psd_delta_f` of the
+    keyword arguments by a single `pycbc.types.FrequencySeries`. The PSD
+    is passed around as a plain array to avoid pickling PyCBC objects.
+    The dict is modified in place.
+    """
+    delta_f = kwargs.pop('psd_delta_f', None)
+    if kwargs.get('psd') is not None:
+        kwargs['psd'] = pycbc.types.FrequencySeries(kwargs['psd'],
+                                                    delta_f=delta_f)
+    return kwargs
 
-    else:
-        raise ValueError("Strain numpy array dimension must be 1 or 2.")
 
+def whiten_segment(strain, **kwargs):
+    """Whiten a single segment.
 
-def worker(inp):
-    fpath = inp.pop('filepath')
-    det = inp.pop('detector')
-    key = inp.pop('segment')
-    with h5py.File(fpath, 'r') as fp:
-        data = whiten(fp[det][key][()], **inp)
+    If a PSD is given, the resulting whitening filter is cached, such
+    that it is computed only once per process for all segments that
+    share the PSD, length and whitening parameters.
+    """
+    unpack_psd(kwargs)
+    psd = kwargs.pop('psd', None)
+    if psd is None:
+        return whiten(strain, **kwargs)
+    # Fill in the defaults of whiten, such that the filter matches
+    # what it would compute itself
+    params = inspect.signature(whiten).bind(strain, **kwargs)
+    params.apply_defaults()
+    params = params.arguments
+    cache_key = (len(strain), params['delta_t'],
+                 params['max_filter_duration'], params['trunc_method'],
+                 params['low_frequency_cutoff'], psd.delta_f,
+                 psd.numpy().tobytes())
+    if cache_key not in _INV_SQRT_PSD_CACHE:
+        delta_t = params['delta_t']
+        max_filter_len = int(params['max_filter_duration']*(1./delta_t))
+        _INV_SQRT_PSD_CACHE[cache_key] = inverse_sqrt_psd(
+            psd, 1./(len(strain)*delta_t), max_filter_len,
+            trunc_method=params['trunc_method'],
+            low_frequency_cutoff=params['low_frequency_cutoff'])
+    return whiten(strain, inv_sqrt_psd=_INV_SQRT_PSD_CACHE[cache_key],
+                  **kwargs)
+
+
+def worker(det, key, strain, kwargs):
+    caster = kwargs.pop('caster', SafeCaster(None))
+    ds_write_kwargs = kwargs.pop('ds_write_kwargs', {})
+    data = whiten_segment(strain, **kwargs)
+    # Cast and compress before returning such that only the final data
+    # is sent back to the main process
+    data = caster(data)
+    if ds_write_kwargs:
+        data = encode_segment(data, ds_write_kwargs)
     return det, key, data
 
 
+def submit_segments(fp, arguments, pool, slots, results):
+    """Read all segments and submit them to the process pool.
+
+    Meant to be run in a separate thread, such that reading the input
+    overlaps with the whitening in the pool. A slot of the semaphore
+    `slots` is acquired for every segment before it is read, which
+    bounds the number of segments kept in memory. Finished segments
+    and errors are put into the queue `results`.
+
+    All input is read by this single thread. It shares h5py's global
+    lock with the writer in the main thread, and every segment is sent
+    to the pool as its own task, including its full input array.
+    """
+    try:
+        for kwargs in arguments:
+            det = kwargs.pop('detector')
+            key = kwargs.pop('segment')
+            slots.acquire()
+            # Use a new array for every segment, as the pool pickles
+            # the arguments asynchronously
+            ds = fp[det][key]
+            strain = np.empty(ds.shape, dtype=ds.dtype)
+            ds.read_direct(strain)
+            pool.apply_async(worker, (det, key, strain, kwargs),
+                             callback=results.put,
+                             error_callback=results.put)
+    except Exception as e:
+        results.put(e)
+
+
 def main(desc):
     parser = ArgumentParser(description=desc)
 
@@ -197,12 +397,22 @@ def main(desc):
                              "corresponding floating point data type before "
                              "whitening.")
     parser.add_argument('--compress', action='store_true',
-                        help="Compress the output file.")
+                        help="Compress the output file using the "
+                             "Bitshuffle filter with LZ4 compression. "
+                             "Reading the output file requires the filter "
+                             "to be available, e.g. by importing "
+                             "`hdf5plugin`.")
     parser.add_argument('--workers', type=int, default=-1,
                         help="Number of processes to use for whitening. Set "
                              "to a negaive number to use as many processes as "
                              "there are CPUs available. Set to 0 to run "
                              "sequentially. Default: -1")
+    parser.add_argument('--shared-psd', action='store_true',
+                        help="Estimate the PSD only once per detector from "
+                             "the longest segment and use it to whiten all "
+                             "segments of that detector. Only use this "
+                             "option if the noise is stationary across "
+                             "segments.")
 
     args = parser.parse_args()
 
@@ -236,17 +446,27 @@ def main(desc):
                   % str(args.dtype)))
     caster = SafeCaster(args.dtype)
     if args.compress:
-        ds_write_kwargs = {'compression': 'gzip', 'compression_opts': 9,
-                           'shuffle': True}
+        import hdf5plugin
+        ds_write_kwargs = dict(hdf5plugin.Bitshuffle(nelems=0, cname='lz4'))
     else:
         ds_write_kwargs = {}
     
     with h5py.File(args.inputfile, 'r') as fp:
+        psds = {}
+        if args.shared_psd:
+            for detector_group_name, in_detector_group in fp.items():
+                logging.debug(("Estimating shared PSD for detector %s"
+                               % detector_group_name))
+                longest = max(in_detector_group.values(), key=len)
+                colored_ts = pycbc.types.TimeSeries(longest[()],
+                                                    delta_t=1. / fp.attrs['sample_rate'])  # noqa: E501
+                psd = colored_ts.psd(args.segment_duration)
+                psds[detector_group_name] = (psd.numpy(), psd.delta_f)
+
         arguments = []
         for detector_group_name, in_detector_group in fp.items():
             for segment_name, in_segment in in_detector_group.items():
                 tmp = {}
-                tmp['filepath'] = args.inputfile
                 tmp['detector'] = detector_group_name
                 tmp['segment'] = segment_name
                 tmp['delta_t'] = 1. / fp.attrs['sample_rate']
@@ -255,42 +475,64 @@ def main(desc):
                 tmp['trunc_method'] = trunc_method
                 tmp['remove_corrupted'] = (not args.keep_corrupted)
                 tmp['low_frequency_cutoff'] = args.low_frequency_cutoff
+                tmp['caster'] = caster
+                tmp['ds_write_kwargs'] = ds_write_kwargs
+                # The pool already parallelizes over segments
+                tmp['fft_workers'] = 1 if args.workers > 0 else -1
+                if detector_group_name in psds:
+                    tmp['psd'], tmp['psd_delta_f'] = psds[detector_group_name]
                 arguments.append(tmp)
     
     with h5py.File(args.inputfile, 'r') as infile,\
          h5py.File(args.outputfile, 'w') as outfile:
         copy_attrs(infile, outfile)
+
+        def store(det, key, data):
+            if det not in outfile:
+                outfile.create_group(det)
+                copy_attrs(infile[det], outfile[det])
+            if isinstance(data, EncodedSegment):
+                ds = outfile[det].create_dataset(key, shape=data.shape,
+                                                 dtype=data.dtype,
+                                                 chunks=chunk_shape(data.shape),  # noqa: E501
+                                                 **ds_write_kwargs)
+                for offset, filter_mask, raw in data.chunks:
+                    ds.id.write_direct_chunk(offset, raw,
+                                             filter_mask=filter_mask)
+            else:
+                ds = outfile[det].create_dataset(key, data=data,
+                                                 chunks=chunk_shape(data.shape),  # noqa: E501
+                                                 **ds_write_kwargs)
+            copy_attrs(infile[det][key], ds)
+            if not args.keep_corrupted:
+                ds.attrs['start_time'] += args.max_filter_duration / 2
+
         if args.workers > 0:
+            slots = threading.Semaphore(2 * args.workers)
+            results = queue.Queue()
             with mp.Pool(args.workers) as pool:
-                for det, key, data in tqdm(pool.imap_unordered(worker,
-                                                               arguments),
-                                           disable=not args.verbose,
-                                           ascii=True,
-                                           total=len(arguments)):
-                    if det not in outfile:
-                        outfile.create_group(det)
-                        copy_attrs(infile[det], outfile[det])
-                    ds = outfile[det].create_dataset(key, data=caster(data),
-                                                     **ds_write_kwargs)
-                    copy_attrs(infile[det][key], ds)
-                    if not args.keep_corrupted:
-                        ds.attrs['start_time'] += args.max_filter_duration / 2
+                reader = threading.Thread(target=submit_segments,
+                                          args=(infile, arguments, pool,
+                                                slots, results),
+                                          daemon=True)
+                reader.start()
+                for _ in tqdm(range(len(arguments)),
+                              disable=not args.verbose,
+                              ascii=True):
+                    res = results.get()
+                    if isinstance(res, Exception):
+                        raise res
+                    store(*res)
+                    slots.release()
+                reader.join()
         else:
             for kwargs in tqdm(arguments,
                                disable=not args.verbose,
                                ascii=True):
-                del kwargs['filepath']
                 det = kwargs.pop('detector')
                 key = kwargs.pop('segment')
-                data = whiten(infile[det][key][()], **kwargs)
-                if det not in outfile:
-                    outfile.create_group(det)
-                    copy_attrs(infile[det], outfile[det])
-                ds = outfile[det].create_dataset(key, data=caster(data),
-                                                 **ds_write_kwargs)
-                copy_attrs(infile[det][key], ds)
-                if not args.keep_corrupted:
-                    ds.attrs['start_time'] += args.max_filter_duration / 2
+                store(*worker(det, key, read_segment(infile[det][key]),
+                              kwargs))
 
 
 if __name__ == '__main__':
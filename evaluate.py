@@ -7,7 +7,8 @@ import numpy as np
 import h5py
 import os
 import logging
-from tqdm import tqdm
+
+EVENT_KEYS = ('time', 'stat', 'var')
 
 
 def find_injection_times(fgfiles, injfile, padding_start=0, padding_end=0):
@@ -56,11 +57,21 @@ def find_injection_times(fgfiles, injfile, padding_start=0, padding_end=0):
     with h5py.File(injfile, 'r') as fp:
         injtimes = fp['tc'][()]
     
-    ret = np.full((len(times), len(injtimes)), False)
-    for i, (start, end) in enumerate(times):
-        ret[i] = np.logical_and(start <= injtimes, injtimes <= end)
-    
-    return duration, np.any(ret, axis=0)
+    if len(times) == 0:
+        return duration, np.full(len(injtimes), False)
+    
+    # An injection is contained if the interval with the latest start
+    # before the injection reaches it. Use the running maximum of the
+    # end times to also handle overlapping intervals.
+    times = np.array(times)
+    order = times[:, 0].argsort()
+    starts = times[order, 0]
+    ends = np.maximum.accumulate(times[order, 1])
+    idxs = np.searchsorted(starts, injtimes, side='right') - 1
+    ret = np.logical_and(idxs >= 0,
+                         ends[np.maximum(idxs, 0)] >= injtimes)
+    
+    return duration, ret
 
 
 def find_closest_index(array, value, assume_sorted=False):
@@ -89,10 +100,12 @@ def find_closest_index(array, value, assume_sorted=False):
         array = array.copy()
         array.sort()
     ridxs = np.searchsorted(array, value, side='right')
-    lidxs = np.maximum(ridxs - 1, 0)
-    comp = np.fabs(array[lidxs] - value) < \
-           np.fabs(array[np.minimum(ridxs, len(array) - 1)] - value)  # noqa: E127, E501
-    lisbetter = np.logical_or((ridxs == len(array)), comp)
+    # As array[ridxs - 1] <= value < array[ridxs] the signs of the
+    # differences are known and no absolute values are required
+    left = array[np.maximum(ridxs - 1, 0)]
+    right = array[np.minimum(ridxs, len(array) - 1)]
+    lisbetter = (ridxs == len(array)) | \
+                ((ridxs > 0) & (value - left < right - value))  # noqa: E127
     ridxs[lisbetter] -= 1
     return ridxs
 
@@ -101,6 +114,52 @@ def mchirp(mass1, mass2):
     return (mass1 * mass2) ** (3. / 5.) / (mass1 + mass2) ** (1. / 5.)
 
 
+def chirp_mass_sums(found_mchirp, fidxs):
+    """Sum the chirp masses of all found injections that are louder than
+    a given threshold.
+    
+    Arguments
+    ---------
+    found_mchirp : np.array
+        The chirp masses of the found injections, sorted by their
+        ranking statistic in ascending order.
+    fidxs : np.array
+        For each threshold the index of the first found injection with
+        a ranking statistic larger than the threshold.
+    
+    Returns
+    -------
+    mc_sum:
+        For each threshold the sum of found_mchirp ** (5 / 2) over all
+        louder found injections.
+    mc_sumsq:
+        For each threshold the sum of found_mchirp ** 5 over all louder
+        found injections.
+    """
+    found_mchirp = np.flip(found_mchirp)
+    
+    # Calculate sum(found_mchirp ** (5/2))
+    # with found_mchirp = found_mchirp[i:]
+    # and i looped over fidxs
+    # Code below is a vectorized form of that
+    cumsum = np.flip(np.cumsum(found_mchirp ** (5./2.)))
+    cumsum = np.concatenate([cumsum, np.zeros(1)])
+    
+    cumsumsq = np.flip(np.cumsum(found_mchirp ** 5))
+    cumsumsq = np.concatenate([cumsumsq, np.zeros(1)])
+    return cumsum[fidxs], cumsumsq[fidxs]
+
+
+def as_event_dict(events):
+    """Return the events as a dictionary with one 1D array per key in
+    `EVENT_KEYS`. Events given as a numpy array with three rows are
+    split into views of the rows.
+    """
+    if isinstance(events, dict):
+        return events
+    return {key: events[i] for i, key in enumerate(EVENT_KEYS)}
+
+
 def get_stats(fgevents, bgevents, injparams, duration=None,
               chirp_distance=False):
     """Calculate the false-alarm rate and sensitivity of a search
@@ -108,21 +167,19 @@ def get_stats(fgevents, bgevents, injparams, duration=None,
     
     Arguments
     ---------
-    fgevents : np.array
-        A numpy array with three rows. The first row has to contain the
-        times returned by the search algorithm where it believes to have
-        found a true signal. The second row contains a ranking statistic
-        like quantity for each time. The third row contains the maxmimum
-        distance to an injection for the given event to be counted as
-        true positive. The values have to be determined on the
-        foreground data, i.e. noise plus additive signals.
-    bgevents : np.array
-        A numpy array with three rows. The first row has to contain the
+    fgevents : dict or np.array
+        A dictionary with the keys `time`, `stat` and `var`, each
+        containing a 1D numpy array. The entry `time` has to contain the
         times returned by the search algorithm where it believes to have
-        found a true signal. The second row contains a ranking statistic
-        like quantity for each time. The third row contains the maxmimum
-        distance to an injection for the given event to be counted as
-        true positive. The values have to be determined on the
+        found a true signal. The entry `stat` contains a ranking
+        statistic like quantity for each time. The entry `var` contains
+        the maxmimum distance to an injection for the given event to be
+        counted as true positive. The values have to be determined on
+        the foreground data, i.e. noise plus additive signals. A numpy
+        array with these quantities as its three rows is accepted as
+        well.
+    bgevents : dict or np.array
+        Same as `fgevents`, but the values have to be determined on the
         background data, i.e. pure noise.
     injparams : dict
         A dictionary containing at least two entries with keys `tc` and
@@ -148,39 +205,42 @@ def get_stats(fgevents, bgevents, injparams, duration=None,
         massc = mchirp(injparams['mass1'], injparams['mass2'])
     if duration is None:
         duration = injtimes.max() - injtimes.min()
+    fgevents = as_event_dict(fgevents)
+    bgevents = as_event_dict(bgevents)
     logging.info('Sorting foreground event times')
-    sidxs = fgevents[0].argsort()
-    fgevents = fgevents.T[sidxs].T
+    sidxs = fgevents['time'].argsort()
+    fgevents = {key: val[sidxs] for key, val in fgevents.items()}
     
     logging.info('Finding injection times closest to event times')
-    idxs = find_closest_index(injtimes, fgevents[0])
+    idxs = find_closest_index(injtimes, fgevents['time'])
     # print(idxs)
-    diff = np.abs(injtimes[idxs] - fgevents[0])
+    diff = np.abs(injtimes[idxs] - fgevents['time'])
     
     logging.info('Finding true- and false-positives')
-    tpbidxs = diff <= fgevents[2]
-    tpidxs = np.arange(len(fgevents[0]))[tpbidxs]
-    fpbidxs = diff > fgevents[2]
-    fpidxs = np.arange(len(fgevents[0]))[fpbidxs]
+    tpbidxs = diff <= fgevents['var']
+    tpidxs = np.flatnonzero(tpbidxs)
+    fpbidxs = diff > fgevents['var']
+    fpidxs = np.flatnonzero(fpbidxs)
     
-    tpevents = fgevents.T[tpidxs].T
-    fpevents = fgevents.T[fpidxs].T
+    tpevents = {key: val[tpidxs] for key, val in fgevents.items()}
+    fpevents = {key: val[fpidxs] for key, val in fgevents.items()}
     
-    ret['fg-events'] = fgevents
+    ret['fg-events'] = np.stack([fgevents[key] for key in EVENT_KEYS])
     ret['found-indices'] = np.arange(len(injtimes))[idxs]
-    ret['missed-indices'] = np.setdiff1d(np.arange(len(injtimes)),
-                                         ret['found-indices'])
+    missed = np.full(len(injtimes), True)
+    missed[ret['found-indices']] = False
+    ret['missed-indices'] = np.flatnonzero(missed)
     ret['true-positive-event-indices'] = tpidxs
     ret['false-positive-event-indices'] = fpidxs
     ret['sorting-indices'] = sidxs
     ret['true-positive-diffs'] = diff[tpidxs]
     ret['false-positive-diffs'] = diff[fpidxs]
-    ret['true-positives'] = tpevents
-    ret['false-positives'] = fpevents
+    ret['true-positives'] = np.stack([tpevents[key] for key in EVENT_KEYS])
+    ret['false-positives'] = np.stack([fpevents[key] for key in EVENT_KEYS])
     
     # Calculate foreground FAR
     logging.info('Calculating foreground FAR')
-    noise_stats = fpevents[1].copy()
+    noise_stats = fpevents['stat'].copy()
     noise_stats.sort()
     fgfar = len(noise_stats) - np.arange(len(noise_stats)) - 1
     fgfar = fgfar / duration
@@ -188,41 +248,28 @@ def get_stats(fgevents, bgevents, injparams, duration=None,
     
     # Calculate background FAR
     logging.info('Calculating background FAR')
-    noise_stats = bgevents[1].copy()
+    noise_stats = bgevents['stat'].copy()
     noise_stats.sort()
     far = len(noise_stats) - np.arange(len(noise_stats)) - 1
     far = far / duration
     ret['far'] = far
     
     # Find best true-positive for each injection
-    verbose = logging.root.level is logging.INFO
-    found_injections = []
-    tmpsidxs = idxs.argsort()
-    sorted_idxs = idxs[tmpsidxs]
-    iidxs = np.full(len(idxs), False)
-    for i in tqdm(range(len(injtimes)), ascii=True, disable=not verbose,
-                  desc='Determining found injections'):
-        L = np.searchsorted(sorted_idxs, i, side='left')
-        if L >= len(idxs) or sorted_idxs[L] != i:
-            continue
-        R = np.searchsorted(sorted_idxs, i, side='right')
-        # All indices that point to the same injection
-        iidxs[tmpsidxs[L:R]] = True
-        # Indices of the true-positives that belong to the same injection
-        eidxs = np.logical_and(iidxs[tmpsidxs[L:R]],
-                               tpbidxs[tmpsidxs[L:R]])  
-        if eidxs.any():
-            found_injections.append([i,
-                                    np.max(fgevents[1][tmpsidxs[L:R]][eidxs])])
-        iidxs[tmpsidxs[L:R]] = False
-    
-    found_injections = np.array(found_injections).T
+    logging.info('Determining found injections')
+    tpinjidxs = idxs[tpbidxs]
+    tpstats = fgevents['stat'][tpbidxs]
+    order = tpinjidxs.argsort()
+    tpinjidxs = tpinjidxs[order]
+    tpstats = tpstats[order]
+    found_idxs, first = np.unique(tpinjidxs, return_index=True)
+    found_injections = np.stack([found_idxs,
+                                 np.maximum.reduceat(tpstats, first)])
     
     # Calculate sensitivity
     # CARE! THIS APPLIES ONLY WHEN THE DISTRIBUTION IS CHOSEN CORRECTLY
     logging.info('Calculating sensitivity')
     sidxs = found_injections[1].argsort()
-    found_injections = found_injections.T[sidxs].T  # Sort found injections
+    found_injections = found_injections[:, sidxs]  # Sort found injections
     if chirp_distance:
         found_mchirp_total = massc[found_injections[0].astype(int)]
         mchirp_max = massc.max()
@@ -235,26 +282,13 @@ def get_stats(fgevents, bgevents, injparams, duration=None,
         mc_norm = Ninj
     prefactor = vtot / mc_norm
     
-    nfound = len(found_injections[1]) - np.searchsorted(found_injections[1],
-                                                        noise_stats,
-                                                        side='right')
+    # Get found injection indices for given threshold
+    fidxs = np.searchsorted(found_injections[1], noise_stats, side='right')
+    nfound = len(found_injections[1]) - fidxs
     if chirp_distance:
-        # Get found chirp-mass indices for given threshold
-        fidxs = np.searchsorted(found_injections[1], noise_stats, side='right')
-        found_mchirp_total = np.flip(found_mchirp_total)
-        
-        # Calculate sum(found_mchirp ** (5/2))
-        # with found_mchirp = found_mchirp_total[i:]
-        # and i looped over fidxs
-        # Code below is a vectorized form of that
-        cumsum = np.flip(np.cumsum(found_mchirp_total ** (5./2.)))
-        cumsum = np.concatenate([cumsum, np.zeros(1)])
-        mc_sum = cumsum[fidxs]
+        mc_sum, sample_variance_prefactor = \
+            chirp_mass_sums(found_mchirp_total, fidxs)
         Ninj = np.sum((mchirp_max / massc) ** (5. / 2.))
-        
-        cumsumsq = np.flip(np.cumsum(found_mchirp_total ** 5))
-        cumsumsq = np.concatenate([cumsumsq, np.zeros(1)])
-        sample_variance_prefactor = cumsumsq[fidxs]
         sample_variance = sample_variance_prefactor / Ninj\
                           - (mc_sum / Ninj) ** 2  # noqa: E127
     else:
@@ -272,6 +306,44 @@ def get_stats(fgevents, bgevents, injparams, duration=None,
     return ret
 
 
+def read_events(fpaths):
+    """Read the events returned by a search from one or more files.
+    
+    Arguments
+    ---------
+    fpaths : list of str
+        Paths to the files containing the events. Each file has to
+        contain the datasets `time`, `stat` and `var`.
+    
+    Returns
+    -------
+    dict:
+        A dictionary with the keys `time`, `stat` and `var`. Each entry
+        is a 1D numpy array containing the according values of all
+        events, in the order of the files. The data type of each entry
+        is the common data type of the datasets in the files.
+    """
+    # Determine the total number of events and their data types first,
+    # such that all files can be read directly into single arrays
+    offsets = [0]
+    dtypes = {key: [] for key in EVENT_KEYS}
+    for fpath in fpaths:
+        with h5py.File(fpath, 'r') as fp:
+            offsets.append(offsets[-1] + fp['time'].shape[0])
+            for key in EVENT_KEYS:
+                dtypes[key].append(fp[key].dtype)
+    
+    events = {key: np.empty(offsets[-1], dtype=np.result_type(*dtypes[key]))
+              for key in EVENT_KEYS}
+    for fpath, start, end in zip(fpaths, offsets[:-1], offsets[1:]):
+        if end == start:
+            continue
+        with h5py.File(fpath, 'r') as fp:
+            for key in EVENT_KEYS:
+                fp[key].read_direct(events[key][start:end])
+    return events
+
+
 def main(doc):
     parser = argparse.ArgumentParser(description=doc)
     
@@ -347,23 +419,11 @@ def main(doc):
     
     # Read foreground events
     logging.info(f'Reading foreground events from {args.foreground_events}')
-    fg_events = []
-    for fpath in args.foreground_events:
-        with h5py.File(fpath, 'r') as fp:
-            fg_events.append(np.vstack([fp['time'],
-                                        fp['stat'],
-                                        fp['var']]))
-    fg_events = np.concatenate(fg_events, axis=-1)
+    fg_events = read_events(args.foreground_events)
     
     # Read background events
     logging.info(f'Reading background events from {args.background_events}')
-    bg_events = []
-    for fpath in args.background_events:
-        with h5py.File(fpath, 'r') as fp:
-            bg_events.append(np.vstack([fp['time'],
-                                        fp['stat'],
-                                        fp['var']]))
-    bg_events = np.concatenate(bg_events, axis=-1)
+    bg_events = read_events(args.background_events)
     
     stats = get_stats(fg_events, bg_events, injparams,
                       duration=dur,